@@ -1,13 +1,22 @@
 import os
 import logging
 import tempfile
+import shutil
 import uuid
-from pathlib import Path
-from flask import Flask, request, jsonify, send_file, render_template
+import queue
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, request, jsonify, send_file, render_template, make_response
 from flask_cors import CORS
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.utils import secure_filename
+from streaming_form_data import StreamingFormDataParser
+from streaming_form_data.targets import BaseTarget, ValueTarget
 # Import our image processing module
-from image_processor import process_zip_file, process_individual_images, extract_zip, generate_image_description
+from image_processor import IMAGE_EXTENSIONS, OAI_CONCURRENCY, extract_zip, generate_image_description
+from tasks import JOB_FAILED_MARKER, submit_job, get_job_state
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -20,8 +29,6 @@ logging.basicConfig(
 
 # Create Flask app
 app = Flask(__name__)
-UPLOAD_FOLDER = "uploads"
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
 # Configure CORS to allow requests from any origin
 CORS(app, resources={r"/*": {"origins": "*"}})
@@ -39,19 +46,272 @@ def after_request(response):
     return response
 
 # Configure upload settings
-UPLOAD_FOLDER = os.path.join(tempfile.gettempdir(), 'image_descriptions')
-OUTPUT_FOLDER = os.path.join(tempfile.gettempdir(), 'image_descriptions_output')
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-os.makedirs(OUTPUT_FOLDER, exist_ok=True)
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.config['MAX_CONTENT_LENGTH'] = 64 * 1024 * 1024  # 64 MB limit
+MAX_CONTENT_LENGTH = 64 * 1024 * 1024  # 64 MB limit
+
+# New jobs only use tmpfs while it has room for several maximum-size jobs
+TMPFS_DIR = '/dev/shm'
+TMPFS_MIN_FREE = 8 * MAX_CONTENT_LENGTH
+
+# Hours a finished job's spreadsheet is kept for download before it is deleted
+JOB_RETENTION = float(os.getenv('JOB_RETENTION_HOURS', '24')) * 60 * 60
+
+# Jobs with no file activity for this long never finished (e.g. their worker was
+# killed) and are deleted too; longer than the 25 hour Batch API wait
+ABANDONED_JOB_AGE = 3 * 24 * 60 * 60
+
+# Seconds between sweeps for expired jobs in each process
+JOB_SWEEP_INTERVAL = 10 * 60
+
+def get_storage_roots():
+    """
+    Choose where job files may be written, in order of preference.
+    Uploads, extracted images and spreadsheets are short-lived, so they go to
+    memory-backed /dev/shm while it has room, falling back to the disk temp dir.
+    UPLOAD_ROOT overrides the choice.
+    """
+    storage_root = os.getenv('UPLOAD_ROOT')
+    if storage_root:
+        return [storage_root]
+    roots = []
+    if os.path.isdir(TMPFS_DIR):
+        roots.append(os.path.join(TMPFS_DIR, 'img_desc'))
+    roots.append(tempfile.gettempdir())
+    return roots
+
+app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
+
+# Allowed file extensions; the image types are the ones the processor describes
+ALLOWED_EXTENSIONS = IMAGE_EXTENSIONS | {'zip'}
+
+# Internal nginx location mapped to OUTPUT_FOLDER; when set, downloads are
+# handed to nginx via X-Accel-Redirect instead of being streamed by Python
+X_ACCEL_REDIRECT_PREFIX = os.getenv('X_ACCEL_REDIRECT_PREFIX')
 
-# Allowed file extensions
-ALLOWED_EXTENSIONS = {'zip', 'png', 'jpg', 'jpeg', 'gif', 'bmp'}
+# Number of spare job directories kept ready per folder
+JOB_DIR_POOL_SIZE = int(os.getenv('JOB_DIR_POOL_SIZE', '8'))
+
+# Size of each read from the request body when streaming uploads
+UPLOAD_CHUNK_SIZE = 64 * 1024
 
 def allowed_file(filename):
-    return '.' in filename and \
-           filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    _, dot, extension = filename.rpartition('.')
+    return bool(dot) and extension.lower() in ALLOWED_EXTENSIONS
+
+class UploadDirTarget(BaseTarget):
+    """Streaming form target that writes each uploaded file straight into a directory."""
+
+    def __init__(self, upload_dir):
+        super().__init__()
+        self.upload_dir = upload_dir
+        self.file_paths = []
+        self._file = None
+
+    def on_start(self):
+        filename = secure_filename(self.multipart_filename or '')
+        if not allowed_file(filename):
+            return  # Skip files with invalid extensions
+        file_path = os.path.join(self.upload_dir, filename)
+        self._file = open(file_path, 'wb')
+        self.file_paths.append(file_path)
+
+    def on_data_received(self, chunk):
+        if self._file:
+            self._file.write(chunk)
+
+    def on_finish(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+def pid_alive(pid):
+    """Return whether a process with this pid exists on this host."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # Exists, but belongs to another user
+    return True
+
+class JobDirPool:
+    """
+    Spare directories created ahead of time and renamed into place for new jobs,
+    so creating a job's directories does not sit on the request path.
+
+    Each process keeps its spares in its own `.pool/<host>-<pid>` directory, so
+    gunicorn workers never count or take each other's. Directories left by
+    processes on this host that have exited are removed at startup.
+    """
+
+    def __init__(self, root, size):
+        pool_root = os.path.join(root, '.pool')
+        owner_prefix = f"{socket.gethostname()}-"
+        self.pool_dir = os.path.join(pool_root, f"{owner_prefix}{os.getpid()}")
+        self.size = size
+        self._spares = queue.Queue()
+        self._refill_lock = threading.Lock()
+        os.makedirs(self.pool_dir, exist_ok=True)
+        self._remove_stale(pool_root, owner_prefix)
+        # Spares left by an earlier process that had the same pid are ours now
+        for name in os.listdir(self.pool_dir):
+            self._spares.put(os.path.join(self.pool_dir, name))
+        self._refill()
+
+    def _remove_stale(self, pool_root, owner_prefix):
+        """Delete the pool directories of exited processes on this host."""
+        if os.name != 'posix':
+            return  # os.kill cannot probe a process without signalling it elsewhere
+        for name in os.listdir(pool_root):
+            path = os.path.join(pool_root, name)
+            if path == self.pool_dir:
+                continue
+            if name.startswith(owner_prefix):
+                pid = name[len(owner_prefix):]
+                if not pid.isdigit() or pid_alive(int(pid)):
+                    continue
+            elif '-' in name:
+                continue  # Another host's pool on a shared volume
+            # A dead process's pool, or a spare from before pools were per process
+            shutil.rmtree(path, ignore_errors=True)
+
+    def _refill(self):
+        if not self._refill_lock.acquire(blocking=False):
+            return  # Another thread is already topping the pool up
+        try:
+            while self._spares.qsize() < self.size:
+                spare = os.path.join(self.pool_dir, uuid.uuid4().hex)
+                os.mkdir(spare)
+                self._spares.put(spare)
+        except OSError as e:
+            logging.warning(f"Could not pre-create job directory in {self.pool_dir}: {e}")
+        finally:
+            self._refill_lock.release()
+
+    def acquire(self, target):
+        """Move a spare directory to target, creating it directly if the pool is empty."""
+        try:
+            os.rename(self._spares.get_nowait(), target)
+            os.utime(target)  # A spare may have waited long enough to look like an abandoned job
+        except (queue.Empty, OSError):
+            os.makedirs(target, exist_ok=True)
+        threading.Thread(target=self._refill, daemon=True).start()
+        return target
+
+class JobStorage:
+    """The upload and output folders under one storage root, with their spare directory pools."""
+
+    def __init__(self, root):
+        self.root = root
+        self.is_tmpfs = root.startswith(TMPFS_DIR + os.sep)
+        self.upload_folder = os.path.join(root, 'image_descriptions')
+        self.output_folder = os.path.join(root, 'image_descriptions_output')
+        os.makedirs(self.upload_folder, exist_ok=True)
+        os.makedirs(self.output_folder, exist_ok=True)
+        self.upload_pool = JobDirPool(self.upload_folder, JOB_DIR_POOL_SIZE)
+        self.output_pool = JobDirPool(self.output_folder, JOB_DIR_POOL_SIZE)
+
+    def has_room(self):
+        """Whether a new job may be stored here; tmpfs is checked before every job."""
+        if not self.is_tmpfs:
+            return True
+        try:
+            return shutil.disk_usage(self.root).free >= TMPFS_MIN_FREE
+        except OSError as e:
+            logging.warning(f"Could not inspect {self.root}: {e}")
+            return False
+
+STORAGES = [JobStorage(root) for root in get_storage_roots()]
+logging.info(f"Storing job files under {', '.join(storage.root for storage in STORAGES)}")
+
+# Preferred folders, used by the legacy /upload route and the nginx download mapping
+UPLOAD_FOLDER = STORAGES[0].upload_folder
+OUTPUT_FOLDER = STORAGES[0].output_folder
+app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+
+def newest_mtime(path):
+    """Return the latest modification time of a directory and the files directly in it."""
+    newest = os.stat(path).st_mtime
+    with os.scandir(path) as entries:
+        for entry in entries:
+            newest = max(newest, entry.stat().st_mtime)
+    return newest
+
+def remove_expired_jobs():
+    """
+    Delete jobs whose spreadsheet (or failure marker) is older than JOB_RETENTION,
+    and the files of jobs with no activity for ABANDONED_JOB_AGE.
+    """
+    now = time.time()
+    for storage in STORAGES:
+        for folder in (storage.output_folder, storage.upload_folder):
+            try:
+                names = [name for name in os.listdir(folder) if name != '.pool']
+            except OSError:
+                continue
+            for name in names:
+                job_dir = os.path.join(folder, name)
+                try:
+                    finished_at = None
+                    for marker in ("descriptions.xlsx", JOB_FAILED_MARKER):
+                        if os.path.exists(os.path.join(job_dir, marker)):
+                            finished_at = os.stat(os.path.join(job_dir, marker)).st_mtime
+                    if finished_at is not None:
+                        expired = now - finished_at > JOB_RETENTION
+                    else:
+                        expired = now - newest_mtime(job_dir) > ABANDONED_JOB_AGE
+                except OSError:
+                    continue  # Removed meanwhile, e.g. by another process's sweep
+                if expired:
+                    shutil.rmtree(job_dir, ignore_errors=True)
+                    logging.info(f"Removed expired job files {job_dir}")
+
+_next_sweep = 0.0
+_sweep_lock = threading.Lock()
+
+def schedule_expired_job_sweep():
+    """Start a background sweep for expired jobs if none ran in the last JOB_SWEEP_INTERVAL."""
+    global _next_sweep
+    with _sweep_lock:
+        now = time.monotonic()
+        if now < _next_sweep:
+            return
+        _next_sweep = now + JOB_SWEEP_INTERVAL
+    threading.Thread(target=remove_expired_jobs, daemon=True).start()
+
+def create_job_dirs():
+    """Generate a job ID and set up its upload and output directories."""
+    schedule_expired_job_sweep()
+    job_id = str(uuid.uuid4())
+    # Fall back from tmpfs to disk once tmpfs runs low
+    storage = next((storage for storage in STORAGES if storage.has_room()), STORAGES[-1])
+    upload_dir = storage.upload_pool.acquire(os.path.join(storage.upload_folder, job_id))
+    output_dir = storage.output_pool.acquire(os.path.join(storage.output_folder, job_id))
+    return job_id, upload_dir, output_dir
+
+def find_output_dir(job_id):
+    """Return the output directory of a job on whichever storage root holds it, or None."""
+    for storage in STORAGES:
+        output_dir = os.path.join(storage.output_folder, job_id)
+        if os.path.isdir(output_dir):
+            return output_dir
+    return None
+
+def remove_job_dirs(upload_dir, output_dir):
+    """Delete the directories of a job that was rejected before it was queued."""
+    shutil.rmtree(upload_dir, ignore_errors=True)
+    shutil.rmtree(output_dir, ignore_errors=True)
+
+def queue_job(job_id, file_paths, output_dir, subject, audience, is_zip):
+    """Start processing the saved uploads in the background and build the 202 response."""
+    submit_job(job_id, file_paths, output_dir, subject, audience, is_zip)
+    
+    # Return immediately; clients poll /jobs/<job_id> and then download
+    return jsonify({
+        'success': True,
+        'job_id': job_id,
+        'status': 'queued',
+        'message': f'Job {job_id} queued for processing'
+    }), 202
 
 @app.route('/health', methods=['GET'])
 def health_check():
@@ -92,14 +352,9 @@ def generate_descriptions():
     audience = request.form.get('audience', 'Students')
     
     # Generate unique job ID and create directories
-    job_id = str(uuid.uuid4())
-    upload_dir = os.path.join(app.config['UPLOAD_FOLDER'], job_id)
-    output_dir = os.path.join(OUTPUT_FOLDER, job_id)
+    job_id, upload_dir, output_dir = create_job_dirs()
     
-    os.makedirs(upload_dir, exist_ok=True)
-    os.makedirs(output_dir, exist_ok=True)
-    
-    # Save files and process based on file type
+    # Save files and queue them for processing based on file type
     try:
         if len(files) == 1 and files[0].filename.lower().endswith('.zip'):
             # Handle ZIP file
@@ -111,12 +366,12 @@ def generate_descriptions():
             file_path = os.path.join(upload_dir, filename)
             file.save(file_path)
             
-            # Process the ZIP file
-            result = process_zip_file(file_path, output_dir, subject, audience)
+            file_paths = [file_path]
+            is_zip = True
             
         else:
             # Handle individual image files
-            image_paths = []
+            file_paths = []
             for file in files:
                 if not allowed_file(file.filename):
                     continue  # Skip files with invalid extensions
@@ -124,28 +379,90 @@ def generate_descriptions():
                 filename = secure_filename(file.filename)
                 file_path = os.path.join(upload_dir, filename)
                 file.save(file_path)
-                image_paths.append(file_path)
+                file_paths.append(file_path)
             
-            if not image_paths:
+            if not file_paths:
                 return jsonify({'error': 'No valid image files found'}), 400
             
-            # Process the individual image files
-            result = process_individual_images(image_paths, output_dir, subject, audience)
+            is_zip = False
+        
+        return queue_job(job_id, file_paths, output_dir, subject, audience, is_zip)
         
-        # Return successful response with excel file path for download
+    except Exception as e:
+        logging.error(f"Error processing files: {e}")
         return jsonify({
-            'success': True,
-            'job_id': job_id,
-            'message': f'Successfully processed {result["total_images"]} images',
-            'total_images': result['total_images'],
-            'excel_file': os.path.basename(result['excel_file'])
-        })
+            'error': f'Error processing files: {str(e)}'
+        }), 500
+
+@app.route('/generate-descriptions/stream', methods=['POST', 'OPTIONS'])
+def generate_descriptions_stream():
+    """
+    Streaming variant of /generate-descriptions.
+    Parses the multipart body incrementally and writes uploaded files directly to disk
+    instead of going through Werkzeug's form parser.
+    """
+    # Handle OPTIONS preflight request
+    if request.method == 'OPTIONS':
+        response = app.make_default_options_response()
+        response.headers.add('Access-Control-Allow-Origin', '*')
+        response.headers.add('Access-Control-Allow-Headers', 'Content-Type, Authorization')
+        response.headers.add('Access-Control-Allow-Methods', 'GET, POST, OPTIONS, PUT, DELETE')
+        return response
         
+    # Check if OPENAI_API_KEY is set
+    if not os.getenv('OPENAI_API_KEY'):
+        return jsonify({
+            'error': 'OpenAI API key is not configured. Please set the OPENAI_API_KEY environment variable.'
+        }), 500
+    
+    # Generate unique job ID and create directories
+    job_id, upload_dir, output_dir = create_job_dirs()
+    file_target = UploadDirTarget(upload_dir)
+    queued = False
+    
+    try:
+        parser = StreamingFormDataParser(headers=request.headers)
+        subject_target = ValueTarget()
+        audience_target = ValueTarget()
+        parser.register('file', file_target)
+        parser.register('subject', subject_target)
+        parser.register('audience', audience_target)
+        
+        # Feed the body to the parser chunk by chunk, enforcing the upload limit.
+        # Werkzeug raises RequestEntityTooLarge itself when the client declared a
+        # Content-Length over the limit; the count catches chunked bodies.
+        max_length = app.config['MAX_CONTENT_LENGTH']
+        bytes_read = 0
+        while chunk := request.stream.read(UPLOAD_CHUNK_SIZE):
+            bytes_read += len(chunk)
+            if bytes_read > max_length:
+                raise RequestEntityTooLarge()
+            parser.data_received(chunk)
+        
+        file_paths = file_target.file_paths
+        if not file_paths:
+            return jsonify({'error': 'No valid image files found'}), 400
+        
+        subject = subject_target.value.decode('utf-8') or 'General Subject'
+        audience = audience_target.value.decode('utf-8') or 'Students'
+        is_zip = len(file_paths) == 1 and file_paths[0].lower().endswith('.zip')
+        
+        response = queue_job(job_id, file_paths, output_dir, subject, audience, is_zip)
+        queued = True
+        return response
+        
+    except RequestEntityTooLarge:
+        return jsonify({'error': 'Upload exceeds the maximum allowed size'}), 413
     except Exception as e:
         logging.error(f"Error processing files: {e}")
         return jsonify({
             'error': f'Error processing files: {str(e)}'
         }), 500
+    finally:
+        # A job that was not queued leaves nothing behind
+        if not queued:
+            file_target.on_finish()
+            remove_job_dirs(upload_dir, output_dir)
 
 @app.route('/download/<job_id>', methods=['GET'])
 def download_results(job_id):
@@ -158,17 +475,29 @@ def download_results(job_id):
             return jsonify({'error': 'Invalid job ID format'}), 400
         
         # Construct the path to the Excel file
-        excel_file_path = os.path.join(OUTPUT_FOLDER, job_id, "descriptions.xlsx")
+        output_dir = find_output_dir(job_id)
+        excel_file_path = os.path.join(output_dir or '', "descriptions.xlsx")
         
-        if not os.path.exists(excel_file_path):
+        if output_dir is None or not os.path.exists(excel_file_path):
             return jsonify({'error': 'File not found'}), 404
         
-        # Send the file as an attachment
+        # Behind nginx, let it stream the file from disk with sendfile; nginx only
+        # maps the preferred output folder, so jobs that fell back to disk are sent here
+        if X_ACCEL_REDIRECT_PREFIX and os.path.dirname(output_dir) == OUTPUT_FOLDER:
+            response = make_response('')
+            response.headers['X-Accel-Redirect'] = f"{X_ACCEL_REDIRECT_PREFIX.rstrip('/')}/{job_id}/descriptions.xlsx"
+            response.headers['Content-Type'] = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+            response.headers['Content-Disposition'] = 'attachment; filename=image_descriptions.xlsx'
+            return response
+        
+        # Send the file as an attachment; gunicorn hands the file wrapper to sendfile
         return send_file(
             excel_file_path,
             as_attachment=True,
             download_name="image_descriptions.xlsx",
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+            conditional=True,
+            etag=True
         )
         
     except Exception as e:
@@ -188,11 +517,12 @@ def get_job_status(job_id):
             return jsonify({'error': 'Invalid job ID format'}), 400
         
         # Check if output directory exists
-        output_dir = os.path.join(OUTPUT_FOLDER, job_id)
-        if not os.path.exists(output_dir):
+        output_dir = find_output_dir(job_id)
+        if output_dir is None:
             return jsonify({'status': 'not_found'}), 404
         
-        # Check for Excel file
+        # The spreadsheet is only moved into place once a job completes, so it marks
+        # completion even after the job's Celery result has expired (and reads as PENDING)
         excel_file_path = os.path.join(output_dir, "descriptions.xlsx")
         if os.path.exists(excel_file_path):
             return jsonify({
@@ -200,7 +530,14 @@ def get_job_status(job_id):
                 'excel_file': 'descriptions.xlsx'
             })
         
-        # If directory exists but no Excel file, it's still processing
+        state = get_job_state(job_id, output_dir)
+        if state == 'FAILURE':
+            return jsonify({'status': 'failed'})
+        
+        if state == 'PENDING':
+            return jsonify({'status': 'queued'})
+        
+        # Otherwise a worker has picked the job up and is still processing it
         return jsonify({'status': 'processing'})
         
     except Exception as e:
@@ -221,15 +558,19 @@ def upload():
     zip_path = os.path.join(UPLOAD_FOLDER, zip_file.filename)
     zip_file.save(zip_path)
 
-    image_paths = extract_zip(zip_path, UPLOAD_FOLDER)
+    image_paths = list(extract_zip(zip_path, UPLOAD_FOLDER))
     results = {}
 
-    for img_path in image_paths:
+    def describe(img_path):
         try:
-            description = generate_image_description(img_path, subject, audience)
-            results[os.path.basename(img_path)] = description
+            return generate_image_description(img_path, subject, audience)
         except Exception as e:
-            results[os.path.basename(img_path)] = f"Error: {str(e)}"
+            return f"Error: {str(e)}"
+
+    # Describe the images concurrently over the shared HTTP/2 client; map keeps archive order
+    with ThreadPoolExecutor(max_workers=OAI_CONCURRENCY) as executor:
+        for img_path, description in zip(image_paths, executor.map(describe, image_paths)):
+            results[os.path.basename(img_path)] = description
 
     return render_template('index.html', results=results)
 
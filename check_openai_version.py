@@ -1,16 +1,14 @@
 import openai
-print(f"OpenAI library version: {openai.__version__}")
 
-# Try both import styles to see which one works
-try:
-    from openai import OpenAI
-    client = OpenAI()
-    print("Successfully imported and initialized OpenAI client using 'from openai import OpenAI'")
-except Exception as e:
-    print(f"Error with 'from openai import OpenAI': {e}")
+def main():
+    print(f"OpenAI library version: {openai.__version__}")
 
-try:
-    client = openai.OpenAI()
-    print("Successfully initialized OpenAI client using 'openai.OpenAI()'")
-except Exception as e:
-    print(f"Error with 'openai.OpenAI()': {e}")
\ No newline at end of file
+    # Report which client style is available without constructing a client,
+    # which would need an API key and may open a connection
+    if hasattr(openai, 'OpenAI'):
+        print("The 'from openai import OpenAI' client interface is available")
+    else:
+        print("The 'OpenAI' client class is not available in this version; use the module-level API")
+
+if __name__ == '__main__':
+    main()
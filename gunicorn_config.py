@@ -4,10 +4,11 @@ import multiprocessing
 # Timeout settings
 timeout = 300  # 5 minutes timeout instead of default 30 seconds
 
-# Worker settings - use fewer workers for memory-intensive apps
-workers = 2  # Reduce number of workers to conserve memory
-worker_class = 'gthread'  # Use threads
-threads = 4  # Number of threads per worker
+# Worker settings - requests only save uploads and poll job state (descriptions are
+# generated by Celery workers), so they spend their time waiting on sockets
+workers = multiprocessing.cpu_count()
+worker_class = 'gevent'  # Cooperative workers; gunicorn monkey-patches the stdlib itself
+worker_connections = 1000  # Concurrent connections per worker
 
 # Memory optimization
 max_requests = 500  # Restart workers after handling this many requests
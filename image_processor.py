@@ -1,15 +1,26 @@
 import os
+import atexit
+import functools
 import zipfile
-import pandas as pd
+import io
+import shutil
 import logging
-import gc
+import hashlib
+import random
+import sqlite3
+import tempfile
 import traceback
+from collections import namedtuple
 from datetime import datetime
-from PIL import Image
-import requests
-import json
-import base64
+from PIL import Image, UnidentifiedImageError
+import xlsxwriter
+import httpx
+import orjson
+import pybase64
+import struct
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -17,354 +28,1487 @@ load_dotenv()
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Vision model used for descriptions
+OPENAI_MODEL = "gpt-4o"
+
+# Base URL of the OpenAI REST API
+OPENAI_API_BASE = "https://api.openai.com/v1"
+
+# Chat completions endpoint every real-time description request is posted to
+OPENAI_CHAT_COMPLETIONS_URL = f"{OPENAI_API_BASE}/chat/completions"
+
+# Jobs with at least this many new images are described through the Batch API,
+# which costs half as much but may take up to 24 hours; 0 disables it
+OAI_BATCH_API_THRESHOLD = int(os.getenv("OAI_BATCH_API_THRESHOLD", "0"))
+
+# Batch API limits per input file, with headroom below the 200 MB size cap
+BATCH_INPUT_MAX_REQUESTS = 50000
+BATCH_INPUT_MAX_BYTES = 180 * 1024 * 1024
+
+# Seconds between Batch API status checks, and the states a batch ends in
+BATCH_POLL_INTERVAL = 30
+BATCH_FINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+# Seconds a batch is waited on before it is cancelled: its 24 hour completion
+# window plus time to finalize. Transient errors while checking on a batch or
+# downloading its results are retried for up to BATCH_RETRY_WINDOW seconds in a row.
+BATCH_WAIT_TIMEOUT = 25 * 60 * 60
+BATCH_RETRY_WINDOW = 60 * 60
+
+# SQLite file caching descriptions by image content, shared across jobs
+DESCRIPTION_CACHE_PATH = os.getenv(
+    "DESCRIPTION_CACHE_PATH",
+    os.path.join(tempfile.gettempdir(), "image_descriptions_cache.sqlite3")
+)
+
+# HTTP statuses worth retrying: rate limiting and transient server errors
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Times the transport re-attempts a failed TCP/TLS connect
+CONNECT_RETRIES = 3
+
+# Number of images described concurrently. The work is dominated by waiting on
+# the OpenAI API, so threads overlap the network round-trips.
+OAI_CONCURRENCY = int(os.getenv("OAI_CONCURRENCY", "8"))
+
+# Upper bound on requests in flight to OpenAI at once across all jobs in this
+# process. Each Celery worker process (prefork child) has its own, so the total
+# is this times the worker concurrency.
+OAI_MAX_IN_FLIGHT = int(os.getenv("OAI_MAX_IN_FLIGHT", str(OAI_CONCURRENCY)))
+_api_semaphore = threading.Semaphore(OAI_MAX_IN_FLIGHT)
+
+# Extra worker threads per job beyond OAI_CONCURRENCY. They read and encode the
+# next payloads while the in-flight requests wait on OpenAI, then queue on the
+# in-flight limit, so a freed slot is refilled without waiting on the CPU work.
+OAI_PREFETCH = int(os.getenv("OAI_PREFETCH", "2"))
+
+# Rate limits this process paces its requests under; 0 disables the limit.
+# They are not shared between processes: set them to the account limits divided
+# by the number of worker processes (the Celery --concurrency).
+OAI_RPM_LIMIT = int(os.getenv("OAI_RPM_LIMIT", "0"))
+OAI_TPM_LIMIT = int(os.getenv("OAI_TPM_LIMIT", "0"))
+
+# Seconds the rate limiter stays slowed down after a 429 response
+RATE_LIMIT_COOLOFF = 60
+
+# Token estimates for rate limiting: images are at most MAX_IMAGE_EDGE on the long
+# edge, which gpt-4o bills as at most four 512px tiles (85 + 4 * 170 tokens)
+IMAGE_TOKEN_ESTIMATE = 765
+PROMPT_TOKEN_ESTIMATE = 150
+
+# Seconds an idle connection is kept open; httpx's 5 second default drops it
+# whenever the rate limiter or a gap between jobs pauses the calls
+KEEPALIVE_EXPIRY = 60
+
+def create_client(pool_size=OAI_CONCURRENCY):
+    """
+    Create an HTTP/2 client for the OpenAI API that is safe to share between threads.
+    Concurrent calls are multiplexed as streams over a kept-alive TLS connection.
+    """
+    transport = httpx.HTTPTransport(
+        http2=True,
+        limits=httpx.Limits(
+            max_connections=pool_size,
+            max_keepalive_connections=pool_size,
+            keepalive_expiry=KEEPALIVE_EXPIRY
+        ),
+        retries=CONNECT_RETRIES  # Re-dial failed connects without spending an API attempt
+    )
+    return httpx.Client(
+        transport=transport,
+        # Connecting should be quick, so give up early and let the transport
+        # re-dial; reading a vision completion can legitimately take a while
+        timeout=httpx.Timeout(90, connect=10)
+    )
+
+# File extensions treated as images
+IMAGE_EXTENSIONS = frozenset({'png', 'jpg', 'jpeg', 'gif', 'bmp'})
+
+# Buffer size used when copying decompressed zip entries to disk
+ZIP_COPY_BUFFER_SIZE = 1024 * 1024
+
+# Column order of the descriptions spreadsheet
+RESULT_COLUMNS = ["Filename", "Format", "Width", "Height", "Subject", "Audience", "Description", "Generated At"]
+
+# Images are downscaled so their long edge fits within this many pixels before upload
+MAX_IMAGE_EDGE = 1024
+JPEG_QUALITY = 85
+
+# Re-encoded images whose grayscale histogram entropy (in bits) is below this are
+# treated as line art, diagrams or scanned text, which stay legible at a lower quality
+LINE_ART_ENTROPY = 4.5
+LINE_ART_JPEG_QUALITY = 60
+
+# Images decoded and re-encoded at once per process. Pillow releases the GIL
+# while it works, so this keeps every core busy, while more description threads
+# than cores would only add decoded full-size bitmaps to peak memory.
+_reencode_semaphore = threading.BoundedSemaphore(os.cpu_count() or 1)
+
+# Number of images sent to the API in a single request; 1 disables batching
+OAI_BATCH_SIZE = int(os.getenv("OAI_BATCH_SIZE", "4"))
+
+# Structured output requested for batched replies: each description names the
+# number of the image it belongs to, so nothing relies on the order of the reply
+BATCH_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "image_descriptions",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "descriptions": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "image": {"type": "integer"},
+                            "description": {"type": "string"}
+                        },
+                        "required": ["image", "description"],
+                        "additionalProperties": False
+                    }
+                }
+            },
+            "required": ["descriptions"],
+            "additionalProperties": False
+        }
+    }
+}
+
+# Formats the OpenAI API accepts without re-encoding
+API_IMAGE_FORMATS = {"jpeg", "png", "gif", "webp"}
+
+# Dimensions and Pillow format name of an image, read once and passed along
+ImageMeta = namedtuple("ImageMeta", ["width", "height", "format"])
+
+# An image inside a ZIP archive, read in place instead of being extracted first.
+# Anywhere an image path is accepted, a ZipMember can be passed instead.
+ZipMember = namedtuple("ZipMember", ["zip_path", "name"])
+
+# Raw bytes encoded per base64 step; a multiple of 3 so no padding appears mid-stream
+BASE64_BLOCK_SIZE = 48 * 1024
+
+class DescriptionError(ValueError):
+    """A failed description attempt, flagged with whether trying again can help."""
+    
+    def __init__(self, message, retryable=True, retry_after=None):
+        super().__init__(message)
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+def _parse_retry_after(response):
+    """Return the server's requested delay in seconds, or None."""
+    try:
+        return float(response.headers["retry-after"])
+    except (KeyError, ValueError):
+        return None
+
+class TokenBucket:
+    """
+    A bucket holding up to `per_minute` units, refilled continuously over a minute.
+    
+    The level may go negative: a request larger than the bucket waits for a full
+    one and then takes its whole amount, and the debt is repaid before the next.
+    """
+    
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+    
+    def refill(self, now, rate_scale):
+        rate = self.capacity / 60.0 * rate_scale
+        self.level = min(self.capacity, self.level + (now - self.updated) * rate)
+        self.updated = now
+    
+    def seconds_until(self, amount, rate_scale):
+        """Time until `amount` units are available; 0 if they are now."""
+        amount = min(amount, self.capacity)  # A request larger than the bucket waits for a full one
+        if self.level >= amount:
+            return 0
+        return (amount - self.level) / (self.capacity / 60.0 * rate_scale)
+
+class RateLimiter:
+    """
+    Proactive requests-per-minute and tokens-per-minute throttle shared by all threads.
+    
+    Calls wait until both buckets can cover them, so a large batch is paced under
+    the account limits instead of running into 429 responses and retry backoff.
+    After a 429 the refill rate is halved until a cool-off period has passed.
+    A limit of 0 disables that bucket.
+    """
+    
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self._lock = threading.Lock()
+        self._buckets = [TokenBucket(requests_per_minute), TokenBucket(tokens_per_minute)]
+        self._rate_scale = 1.0
+        self._cooloff_until = 0.0
+    
+    def acquire(self, tokens):
+        """Block until a request estimated at `tokens` tokens may be sent."""
+        requests_bucket, tokens_bucket = self._buckets
+        amounts = [(requests_bucket, 1), (tokens_bucket, tokens)]
+        amounts = [(bucket, amount) for bucket, amount in amounts if bucket.capacity > 0]
+        if not amounts:
+            return
+        
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now >= self._cooloff_until:
+                    self._rate_scale = 1.0
+                wait = 0
+                for bucket, amount in amounts:
+                    bucket.refill(now, self._rate_scale)
+                    wait = max(wait, bucket.seconds_until(amount, self._rate_scale))
+                if wait == 0:
+                    for bucket, amount in amounts:
+                        bucket.level -= amount
+                    return
+            time.sleep(wait)
+    
+    def penalize(self, retry_after=None):
+        """Slow down after the API rejected a request for exceeding the rate limit."""
+        with self._lock:
+            now = time.monotonic()
+            self._rate_scale = max(self._rate_scale / 2, 0.1)
+            self._cooloff_until = now + max(retry_after or 0, RATE_LIMIT_COOLOFF)
+            for bucket in self._buckets:
+                bucket.refill(now, self._rate_scale)
+                bucket.level = 0.0
+
+def estimate_tokens(payload):
+    """Rough upper bound of the tokens a chat payload counts against the TPM limit."""
+    content = payload["messages"][-1]["content"]
+    image_count = sum(1 for part in content if part.get("type") == "image_url")
+    return PROMPT_TOKEN_ESTIMATE + image_count * IMAGE_TOKEN_ESTIMATE + payload.get("max_tokens", 0)
+
+# Shared client so every job in the process multiplexes over the same connections.
+# It stays open for the life of the process and is closed on interpreter exit,
+# so the TLS connection is shut down cleanly rather than dropped.
+_client = create_client()
+atexit.register(_client.close)
+
+# Shared throttle so every job in the process stays under the per-process limits
+_rate_limiter = RateLimiter(OAI_RPM_LIMIT, OAI_TPM_LIMIT)
+
+# A batched request larger than the token bucket is still paced correctly, but
+# has to wait for the whole bucket to refill before every request
+_largest_request_tokens = PROMPT_TOKEN_ESTIMATE + OAI_BATCH_SIZE * (IMAGE_TOKEN_ESTIMATE + 300)
+if 0 < OAI_TPM_LIMIT < _largest_request_tokens:
+    logging.warning(f"OAI_TPM_LIMIT={OAI_TPM_LIMIT} is below the estimated {_largest_request_tokens} tokens of one "
+                    f"request of {OAI_BATCH_SIZE} images; such requests will be spaced about "
+                    f"{60 * _largest_request_tokens / OAI_TPM_LIMIT:.0f} seconds apart")
+
+def is_image_filename(filename):
+    """Check a filename's extension against IMAGE_EXTENSIONS, lowercasing only the suffix."""
+    _, dot, extension = filename.rpartition('.')
+    return bool(dot) and extension.lower() in IMAGE_EXTENSIONS
+
+def _safe_extract_path(member_name, extract_dir):
+    """Map a zip entry name to a path inside extract_dir, dropping absolute and '..' parts."""
+    arcname = os.path.splitdrive(member_name.replace('\\', '/'))[1]
+    parts = [part for part in arcname.split('/') if part not in ('', os.path.curdir, os.path.pardir)]
+    return os.path.join(extract_dir, *parts)
+
 def extract_zip(zip_path, extract_dir):
-    """Extract contents of a zip file to the specified directory."""
+    """
+    Extract the image files in a zip file to the specified directory.
+    
+    This is a generator: each path is yielded, in archive order, as soon as
+    that entry has been written, so callers can start on the first images
+    while the rest of the archive is still being extracted.
+    """
+    # Only image entries are written to disk; everything else in the archive is skipped
     with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-        zip_ref.extractall(extract_dir)
+        members = {}
+        for member in zip_ref.infolist():
+            if member.is_dir() or not is_image_filename(member.filename):
+                continue
+            # Entries repeating a path (or differing only by '..' parts) are extracted once
+            members.setdefault(_safe_extract_path(member.filename, extract_dir), member.filename)
+    
+    # Create the directory tree up front so worker threads never race on makedirs
+    for directory in {os.path.dirname(target) for target in members}:
+        os.makedirs(directory, exist_ok=True)
     
-    # Get list of image files
-    image_files = []
-    for root, _, files in os.walk(extract_dir):
-        for file in files:
-            if file.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp')):
-                image_files.append(os.path.join(root, file))
+    # zlib releases the GIL while inflating, so entries decompress in parallel.
+    # ZipFile objects are not safe to share between readers, so each thread opens its own.
+    local = threading.local()
+    handles = []
     
-    return image_files
+    def extract_one(target):
+        zip_ref = getattr(local, 'zip_ref', None)
+        if zip_ref is None:
+            zip_ref = local.zip_ref = zipfile.ZipFile(zip_path, 'r')
+            handles.append(zip_ref)
+        with zip_ref.open(members[target]) as source, open(target, 'wb') as dest:
+            shutil.copyfileobj(source, dest, ZIP_COPY_BUFFER_SIZE)
+        return target
+    
+    try:
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            yield from executor.map(extract_one, members)
+    finally:
+        for zip_ref in handles:
+            zip_ref.close()
+
+def list_zip_images(zip_path):
+    """Return a ZipMember for each image entry in a zip file, in archive order."""
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        # Entries repeating a name are read once; ZipFile.open returns the last of them
+        names = dict.fromkeys(
+            member.filename for member in zip_ref.infolist()
+            if not member.is_dir() and is_image_filename(member.filename)
+        )
+    return [ZipMember(zip_path, name) for name in names]
+
+_zip_handles = threading.local()
+
+def open_image(image_path):
+    """
+    Open an image for reading in binary mode.
+    
+    Args:
+        image_path: Path to an image file, or a ZipMember to read from its archive
+        
+    Returns:
+        Binary file object; ZIP entries are decompressed as they are read
+    """
+    if not isinstance(image_path, ZipMember):
+        return open(image_path, "rb")
+    
+    # ZipFile objects are not safe to share between readers, so each thread keeps
+    # its own handle per archive; they close when the job's worker threads exit
+    handles = getattr(_zip_handles, 'handles', None)
+    if handles is None:
+        handles = _zip_handles.handles = {}
+    zip_ref = handles.get(image_path.zip_path)
+    if zip_ref is None:
+        zip_ref = handles[image_path.zip_path] = zipfile.ZipFile(image_path.zip_path, 'r')
+    return zip_ref.open(image_path.name)
+
+def close_zip_handles():
+    """Close the archive handles open_image cached for the calling thread."""
+    handles = getattr(_zip_handles, 'handles', None)
+    if handles:
+        for zip_ref in handles.values():
+            zip_ref.close()
+        handles.clear()
 
-def generate_image_description(image_path, subject, audience, max_retries=3):
+def image_name(image_path):
+    """Return the file name of an image path or ZipMember."""
+    if isinstance(image_path, ZipMember):
+        return image_path.name.replace('\\', '/').rpartition('/')[2]
+    return os.path.basename(image_path)
+
+class DescriptionCache:
+    """
+    Persistent cache of generated descriptions keyed by image content.
+    
+    Repeated figures (common in textbook ZIPs) and re-submitted jobs reuse the
+    stored description instead of paying for another API call. Backed by SQLite
+    so every worker process on the host shares it. Within a process, a key can
+    be claimed while it is being described, so identical images in flight at
+    the same time wait for one request instead of each sending their own.
+    """
+    
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS descriptions (key TEXT PRIMARY KEY, description TEXT NOT NULL)"
+        )
+        self._conn.commit()
+    
+    @staticmethod
+    def make_key(image_data, subject, audience, model=OPENAI_MODEL):
+        """Build the cache key for an image's bytes and the prompt parameters."""
+        digest = hashlib.blake2b(image_data, digest_size=20).hexdigest()
+        return f"{digest}:{model}:{subject}:{audience}"
+    
+    def get(self, key):
+        """Return the cached description for key, or None."""
+        try:
+            with self._lock:
+                row = self._conn.execute(
+                    "SELECT description FROM descriptions WHERE key = ?", (key,)
+                ).fetchone()
+        except sqlite3.Error as e:
+            logging.warning(f"Description cache lookup failed: {str(e)}")
+            return None
+        return row[0] if row else None
+    
+    def set(self, key, description):
+        """Store a generated description under key."""
+        try:
+            with self._lock:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO descriptions (key, description) VALUES (?, ?)",
+                    (key, description)
+                )
+                self._conn.commit()
+        except sqlite3.Error as e:
+            logging.warning(f"Description cache write failed: {str(e)}")
+    
+    def claim(self, key):
+        """Mark key as being described; returns False if another request already is."""
+        with self._pending_lock:
+            if key in self._pending:
+                return False
+            self._pending[key] = threading.Event()
+            return True
+    
+    def release(self, key):
+        """Drop a claim taken with claim() and wake any requests waiting on it."""
+        with self._pending_lock:
+            event = self._pending.pop(key)
+        event.set()
+    
+    def wait(self, key):
+        """
+        Wait for a claimed key to be released, then return its cached description.
+        Returns None if the request holding the claim failed. Callers must not
+        hold claims of their own while waiting.
+        """
+        with self._pending_lock:
+            event = self._pending.get(key)
+        if event is not None:
+            event.wait()
+        return self.get(key)
+
+_description_cache = None
+_description_cache_lock = threading.Lock()
+
+def get_description_cache():
+    """Return the process-wide description cache, opening it on first use."""
+    global _description_cache
+    with _description_cache_lock:
+        if _description_cache is None:
+            _description_cache = DescriptionCache(DESCRIPTION_CACHE_PATH)
+        return _description_cache
+
+def prepare_image(image_data, meta=None):
+    """
+    Turn raw image file bytes into bytes ready to send to the API.
+    
+    gpt-4o gains nothing from pixels beyond its tile budget, so images whose long
+    edge exceeds MAX_IMAGE_EDGE, or whose format the API does not accept, are
+    downscaled and re-encoded as JPEG in memory. Anything else is sent as-is.
+    
+    Args:
+        image_data: Contents of the image file
+        meta: Optional ImageMeta already read from the image header; without it
+            the header is parsed from image_data. When it shows no re-encoding
+            is needed, Pillow is never involved.
+        
+    Returns:
+        Tuple of (image bytes or memoryview, lowercase format name)
+    """
+    if meta is None:
+        meta = parse_image_header(io.BytesIO(image_data))
+    if meta is not None:
+        format_name = (meta.format or "unknown").lower()
+        if max(meta.width, meta.height) <= MAX_IMAGE_EDGE and format_name in API_IMAGE_FORMATS:
+            return image_data, format_name
+    
+    with _reencode_semaphore, Image.open(io.BytesIO(image_data)) as img:
+        format_name = (img.format or "unknown").lower()
+        
+        if max(img.size) <= MAX_IMAGE_EDGE and format_name in API_IMAGE_FORMATS:
+            return image_data, format_name
+        
+        # Let libjpeg scale JPEGs down by 1/2 to 1/8 while decoding, so a large
+        # photo is never decoded at full resolution; thumbnail() finishes the job
+        scale = MAX_IMAGE_EDGE / max(img.size)
+        img.draft("RGB", (max(1, round(img.width * scale)), max(1, round(img.height * scale))))
+        img.thumbnail((MAX_IMAGE_EDGE, MAX_IMAGE_EDGE), Image.Resampling.LANCZOS)
+        if img.mode != "RGB":
+            img = img.convert("RGB")  # JPEG has no alpha or palette modes
+        
+        # Flat, mostly two-tone figures compress far better than photos, so they
+        # get a lower quality; the entropy check costs a single histogram pass
+        quality = JPEG_QUALITY
+        if img.convert("L").entropy() < LINE_ART_ENTROPY:
+            quality = LINE_ART_JPEG_QUALITY
+        
+        # Skip the extra Huffman-table pass of optimize=True; it only trims a few percent
+        buffer = io.BytesIO()
+        img.save(buffer, format="JPEG", quality=quality)
+        # Hand out a view of the buffer rather than copying the JPEG with getvalue()
+        return buffer.getbuffer(), "jpeg"
+
+# JPEG start-of-frame markers, which carry the image dimensions
+JPEG_SOF_MARKERS = frozenset({0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF})
+
+def _read_jpeg_size(image_file):
+    """Walk the JPEG marker segments up to the first start-of-frame and return (width, height)."""
+    image_file.seek(2)  # Past the SOI marker
+    while True:
+        marker = image_file.read(2)
+        while marker[:1] == b"\xff" and marker[1:] == b"\xff":
+            marker = marker[1:] + image_file.read(1)  # Fill bytes before a marker
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+        code = marker[1]
+        if code == 0x01 or 0xD0 <= code <= 0xD8:
+            continue  # Markers without a length field
+        header = image_file.read(2)
+        if len(header) < 2:
+            return None
+        length, = struct.unpack(">H", header)
+        if code in JPEG_SOF_MARKERS:
+            frame = image_file.read(5)
+            if len(frame) < 5:
+                return None
+            height, width = struct.unpack(">xHH", frame)
+            return width, height
+        image_file.seek(length - 2, os.SEEK_CUR)
+
+def parse_image_header(image_file):
+    """
+    Parse an image's dimensions and format from the header of an open binary file.
+    
+    Handles PNG, GIF, BMP and JPEG without decoding any pixels.
+    
+    Args:
+        image_file: Binary file object positioned at the start of the image
+        
+    Returns:
+        ImageMeta with Pillow's format name, or None for other or malformed files
+    """
+    head = image_file.read(26)
+    size = None
+    if head.startswith(b"\x89PNG\r\n\x1a\n") and head[12:16] == b"IHDR":
+        format_name = "PNG"
+        size = struct.unpack(">II", head[16:24])
+    elif head[:6] in (b"GIF87a", b"GIF89a"):
+        format_name = "GIF"
+        size = struct.unpack("<HH", head[6:10])
+    elif head.startswith(b"BM") and len(head) >= 26:
+        format_name = "BMP"
+        header_size, = struct.unpack("<I", head[14:18])
+        if header_size == 12:  # OS/2 BITMAPCOREHEADER
+            size = struct.unpack("<HH", head[18:22])
+        else:
+            width, height = struct.unpack("<ii", head[18:26])
+            size = (abs(width), abs(height))  # Negative height means top-down rows
+    elif head.startswith(b"\xff\xd8\xff"):
+        format_name = "JPEG"
+        size = _read_jpeg_size(image_file)
+    
+    if size is None:
+        return None
+    return ImageMeta(size[0], size[1], format_name)
+
+# Metadata recorded for an image whose header cannot be read
+UNKNOWN_IMAGE_META = ImageMeta(0, 0, "Unknown")
+
+def read_image_header(image_path):
+    """
+    Read an image's dimensions and format from its header without decoding it.
+    
+    PNG, GIF, BMP and JPEG headers are parsed directly; other files fall back
+    to Pillow, which also only reads the header on open.
+    
+    Args:
+        image_path: Path to the image file, or a ZipMember
+        
+    Returns:
+        ImageMeta with Pillow's format name
+    """
+    with open_image(image_path) as image_file:
+        meta = parse_image_header(image_file)
+    if meta is not None:
+        return meta
+    
+    with open_image(image_path) as image_file, Image.open(image_file) as img:
+        return ImageMeta(img.size[0], img.size[1], img.format or "Unknown")
+
+def read_image_meta(image_path):
+    """Read an image's header metadata, logging and defaulting when it cannot be read."""
+    try:
+        # Only the header is needed; the image is decoded later if it must be resized
+        return read_image_header(image_path)
+    except Exception as img_error:
+        logging.error(f"Error reading image {image_path}: {str(img_error)}")
+        # Continue processing with default values
+        return UNKNOWN_IMAGE_META
+
+# System message shared by every description request; it does not depend on
+# the job, so it is built once and referenced from each payload
+SYSTEM_MESSAGE = {
+    "role": "system", 
+    # "content": f"You are a VI educator, expert at describing images for {audience} (blind students) studying {subject}. "
+    #           f"Provide clear, detailed, and educational descriptions that focus on aspects "
+    #           f"relevant to {subject}. Avoid adding irrelevant information like colours, "
+    #           f"Be factual, educational, and appropriate for the audience level."
+    "content": "Generate image description for a blind person, keep it contextual, considering the age and grade of the book."
+    "Go from general to specific, be concise and objective and keep tone and language of the description relevant to the grade of the book."
+    "Don't include colours and irrelevant information and make it straightforward."
+}
+
+def build_image_content(image_path, image_data, meta=None):
+    """Prepare an image and wrap it as an image_url content part for the chat payload."""
+    # Prepare the image, downscaled in memory if it is larger than the model uses
+    try:
+        upload_data, format_name = prepare_image(image_data, meta)
+    except UnidentifiedImageError:
+        # Pillow's message names the in-memory buffer rather than the file
+        logging.error(f"Error processing image {image_path}: not a recognised image")
+        raise DescriptionError(f"Image processing error: cannot identify image file {image_name(image_path)}", retryable=False)
+    except Exception as img_error:
+        logging.error(f"Error processing image {image_path}: {str(img_error)}")
+        raise DescriptionError(f"Image processing error: {str(img_error)}", retryable=False)
+    
+    return {
+        "type": "image_url",
+        "image_url": {
+            "url": encode_data_url(upload_data, format_name)
+        }
+    }
+
+def encode_data_url(image_data, format_name):
+    """
+    Build the base64 data URL for an image.
+    
+    The encoding is appended block by block to a buffer that already holds the
+    data URL prefix, so the only full-size copies are that buffer and the final
+    string, instead of separate encoded bytes, decoded string and f-string.
+    pybase64 encodes with SIMD kernels, several times faster than the stdlib.
+    """
+    url = bytearray(f"data:image/{format_name.lower()};base64,".encode('ascii'))
+    view = memoryview(image_data)
+    for start in range(0, len(view), BASE64_BLOCK_SIZE):
+        url += pybase64.b64encode(view[start:start + BASE64_BLOCK_SIZE])
+    # The output is pure ASCII, so skip the UTF-8 decoder
+    return url.decode('ascii')
+
+@functools.lru_cache(maxsize=4)
+def api_headers(api_key):
+    """Return the request headers for api_key, built once and shared by every call."""
+    return {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {api_key}"
+    }
+
+def request_completion(payload, client, label):
+    """
+    Send a chat completion payload to OpenAI and return the reply text.
+    
+    Args:
+        payload: Chat completion request body
+        client: httpx client to send the request on
+        label: Name used in log messages (e.g. the image filename)
+        
+    Returns:
+        The content of the first choice's message
+    """
+    # Get API key from environment
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        raise ValueError("OpenAI API key not found in environment variables")
+    
+    headers = api_headers(api_key)
+    
+    # Serialize with orjson; the payload is dominated by the multi-MB base64
+    # string, which the stdlib encoder scans and copies much more slowly
+    body = orjson.dumps(payload)
+    
+    # Make the API request with proper error handling and timeout
+    try:
+        _rate_limiter.acquire(estimate_tokens(payload))
+        with _api_semaphore:
+            response = client.post(
+                OPENAI_CHAT_COMPLETIONS_URL,
+                headers=headers,
+                content=body
+            )
+        
+        # Check if the response status code indicates success
+        response.raise_for_status()
+        
+        # Parse the response JSON straight from the body bytes
+        response_data = orjson.loads(response.content)
+        
+        if 'error' in response_data:
+            raise ValueError(f"API Error: {response_data['error']['message']}")
+            
+        # Extract the description
+        return response_data['choices'][0]['message']['content']
+        
+    except httpx.HTTPStatusError as http_err:
+        retry_after = _parse_retry_after(http_err.response)
+        if http_err.response.status_code == 429:
+            _rate_limiter.penalize(retry_after)
+        # Client errors other than rate limiting fail the same way every time
+        raise DescriptionError(
+            f"HTTP Error: {http_err}",
+            retryable=http_err.response.status_code in RETRYABLE_STATUS_CODES,
+            retry_after=retry_after
+        )
+    except httpx.TimeoutException:
+        logging.error(f"API request timed out for {label}")
+        raise ValueError("Timeout Error: The request to OpenAI API timed out")
+    except httpx.ConnectError:
+        raise ValueError("Connection Error: Could not connect to OpenAI API")
+    except httpx.HTTPError as req_err:
+        raise ValueError(f"Request Error: {req_err}")
+
+def call_with_retries(func, max_retries, label):
+    """
+    Call func until it succeeds, backing off exponentially; re-raises the last error.
+    Errors marked as not retryable are raised at once, and a server-requested
+    Retry-After delay is honoured when it is longer than the backoff. Each delay
+    is jittered so threads that failed together do not all retry at once.
+    """
+    retry_count = 0
+    backoff_time = 2  # Initial backoff time in seconds
+    
+    while True:
+        try:
+            return func()
+        except Exception as e:
+            retry_count += 1
+            logging.warning(f"Attempt {retry_count}/{max_retries} failed for {label}: {str(e)}")
+            
+            if retry_count >= max_retries or not getattr(e, "retryable", True):
+                logging.error(f"Failed to generate description after {retry_count} attempts: {str(e)}")
+                raise
+            
+            jittered = backoff_time / 2 + random.uniform(0, backoff_time / 2)
+            delay = max(jittered, getattr(e, "retry_after", None) or 0)
+            logging.info(f"Retrying in {delay:.1f} seconds...")
+            time.sleep(delay)
+            backoff_time *= 2  # Exponential backoff
+
+def build_description_payload(image_path, image_data, subject, audience, meta=None):
+    """Build the chat completion request body that describes a single image."""
+    # Prepare payload for GPT-4 Vision API
+    return {
+        "model": OPENAI_MODEL,
+        "messages": [
+            SYSTEM_MESSAGE,
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": f"Please describe this image for {audience} (blind students) studying {subject}."},
+                    build_image_content(image_path, image_data, meta)
+                ]
+            }
+        ],
+        "max_tokens": 300
+    }
+
+def generate_image_description(image_path, subject, audience, max_retries=3, client=None, meta=None):
     """
     Generate a description for an image using OpenAI's API.
     
     Args:
-        image_path: Path to the image file
+        image_path: Path to the image file, or a ZipMember
         subject: The subject area (e.g., Mathematics, Biology)
         audience: The target audience (e.g., Elementary school students)
         max_retries: Maximum number of retries on API failure
+        client: Optional httpx client to send the API call on
+        meta: Optional ImageMeta of the image if the caller already read it
         
     Returns:
         A description of the image contextual to the subject and audience
     """
-    retry_count = 0
-    backoff_time = 2  # Initial backoff time in seconds
-    temp_path = None
-    format_name = "unknown"
-    width = 0
-    height = 0
+    client = client or _client
+    
+    # Read the file once; its bytes also key the description cache. A file or
+    # ZIP entry that cannot be read is reported for this image alone.
+    try:
+        with open_image(image_path) as image_file:
+            image_data = image_file.read()
+    except Exception as e:
+        logging.error(f"Error reading image {image_name(image_path)}: {str(e)}")
+        return f"Error generating description: {str(e)}"
+    
+    cache = get_description_cache()
+    cache_key = cache.make_key(image_data, subject, audience)
+    description = cache.get(cache_key)
+    if description is not None:
+        logging.info(f"Using cached description for {image_name(image_path)}")
+        return description
+    
+    # An identical image already being described shares that request's result;
+    # if that request fails, the waiting images take turns trying themselves
+    while not cache.claim(cache_key):
+        description = cache.wait(cache_key)
+        if description is not None:
+            logging.info(f"Using description of an identical image for {image_name(image_path)}")
+            return description
+    
+    def describe():
+        payload = build_description_payload(image_path, image_data, subject, audience, meta)
+        return request_completion(payload, client, image_name(image_path))
     
-    while retry_count < max_retries:
+    try:
+        description = call_with_retries(describe, max_retries, image_path)
+        cache.set(cache_key, description)
+    except Exception as e:
+        return f"Error generating description: {str(e)}"
+    finally:
+        cache.release(cache_key)
+    
+    logging.info(f"Generated description for {image_name(image_path)}")
+    return description
+
+def api_request(client, method, path, headers=None, **kwargs):
+    """
+    Send a request to an OpenAI REST endpoint other than chat completions.
+    
+    Args:
+        client: httpx client to send the request on
+        method: HTTP method
+        path: Endpoint path below OPENAI_API_BASE (e.g. "/files")
+        headers: Extra request headers
+        **kwargs: Passed through to httpx (content, files, data, ...)
+        
+    Returns:
+        The successful httpx response
+    """
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        raise ValueError("OpenAI API key not found in environment variables")
+    
+    try:
+        response = client.request(
+            method,
+            f"{OPENAI_API_BASE}{path}",
+            headers={"Authorization": f"Bearer {api_key}", **(headers or {})},
+            **kwargs
+        )
+        response.raise_for_status()
+    except httpx.HTTPStatusError as http_err:
+        # Client errors such as a bad key or an unknown id fail the same way every time
+        raise DescriptionError(
+            f"HTTP Error: {http_err}",
+            retryable=http_err.response.status_code in RETRYABLE_STATUS_CODES,
+            retry_after=_parse_retry_after(http_err.response)
+        )
+    return response
+
+def retry_transient(func, label):
+    """
+    Call func until it succeeds, waiting BATCH_POLL_INTERVAL seconds (or the
+    server's Retry-After) between attempts. Errors marked as not retryable, and
+    errors still occurring after BATCH_RETRY_WINDOW seconds, are re-raised.
+    """
+    deadline = time.monotonic() + BATCH_RETRY_WINDOW
+    while True:
         try:
-            # Get basic image info and prepare image - use context manager for auto-closing
-            image_path_to_use = image_path
-            
+            return func()
+        except Exception as e:
+            if not getattr(e, "retryable", True) or time.monotonic() >= deadline:
+                raise
+            logging.warning(f"Request for {label} failed, retrying: {str(e)}")
+            time.sleep(max(BATCH_POLL_INTERVAL, getattr(e, "retry_after", None) or 0))
+
+def cancel_batch(batch_id, client):
+    """Cancel a Batch API job so it stops billing; failures are logged, not raised."""
+    try:
+        api_request(client, "POST", f"/batches/{batch_id}/cancel")
+        logging.info(f"Cancelled batch {batch_id}")
+    except Exception as e:
+        logging.error(f"Could not cancel batch {batch_id}: {str(e)}")
+
+def submit_batch(input_file, client):
+    """
+    Upload a JSONL file of chat completion requests and start a Batch API job for it.
+    
+    Args:
+        input_file: Binary file object holding the request lines
+        client: httpx client to send the requests on
+        
+    Returns:
+        The id of the created batch
+    """
+    input_file.seek(0)
+    upload = api_request(
+        client, "POST", "/files",
+        files={"file": ("descriptions.jsonl", input_file, "application/jsonl")},
+        data={"purpose": "batch"}
+    )
+    batch = api_request(
+        client, "POST", "/batches",
+        headers={"Content-Type": "application/json"},
+        content=orjson.dumps({
+            "input_file_id": orjson.loads(upload.content)["id"],
+            "endpoint": "/v1/chat/completions",
+            "completion_window": "24h"
+        })
+    )
+    return orjson.loads(batch.content)["id"]
+
+def wait_for_batch(batch_id, client):
+    """
+    Poll a Batch API job until it ends and yield the result of each successful request.
+    
+    Args:
+        batch_id: Id returned by submit_batch
+        client: httpx client to send the requests on
+        
+    Yields:
+        (custom_id, description) tuples; failed requests are left out
+    """
+    deadline = time.monotonic() + BATCH_WAIT_TIMEOUT
+    while True:
+        batch = orjson.loads(retry_transient(
+            lambda: api_request(client, "GET", f"/batches/{batch_id}"), f"batch {batch_id}"
+        ).content)
+        if batch["status"] in BATCH_FINAL_STATUSES:
+            break
+        if time.monotonic() >= deadline:
+            raise TimeoutError(f"Batch {batch_id} still {batch['status']} after {BATCH_WAIT_TIMEOUT} seconds")
+        time.sleep(BATCH_POLL_INTERVAL)
+    
+    counts = batch.get("request_counts") or {}
+    logging.info(f"Batch {batch_id} {batch['status']}: {counts.get('completed', 0)} of {counts.get('total', 0)} requests completed")
+    
+    # Expired and cancelled batches still return the requests that finished
+    if not batch.get("output_file_id"):
+        return
+    output = retry_transient(
+        lambda: api_request(client, "GET", f"/files/{batch['output_file_id']}/content"), f"batch {batch_id}"
+    )
+    for line in output.content.splitlines():
+        if not line.strip():
+            continue
+        result = orjson.loads(line)
+        response = result.get("response") or {}
+        if response.get("status_code") != 200:
+            continue
+        yield result["custom_id"], response["body"]["choices"][0]["message"]["content"]
+
+def prefill_cache_with_batch_api(image_paths, subject, audience, client=None):
+    """
+    Describe images through OpenAI's Batch API and store the results in the description cache.
+    
+    The regular pipeline then picks the descriptions up as cache hits, and only
+    images the batch failed on are sent to the real-time endpoint. Blocks until
+    every batch has ended. If anything fails, batches still running are cancelled
+    before the error is raised, so the real-time fallback never pays for the
+    same images twice.
+    
+    Args:
+        image_paths: Paths to image files or ZipMembers
+        subject: Subject area for context
+        audience: Target audience for descriptions
+        client: Optional httpx client to send the API calls on
+        
+    Returns:
+        Number of descriptions added to the cache
+    """
+    client = client or _client
+    cache = get_description_cache()
+    batch_ids = []  # Submitted batches not yet waited on to the end
+    cache_keys = {}  # custom_id -> description cache key
+    queued_keys = set()
+    input_file = None
+    request_count = 0
+    
+    # Write one request line per distinct uncached image to a temporary file,
+    # starting a new batch whenever a file reaches the Batch API limits
+    try:
+        for image_path in image_paths:
+            with open_image(image_path) as image_file:
+                image_data = image_file.read()
+            cache_key = cache.make_key(image_data, subject, audience)
+            if cache_key in queued_keys or cache.get(cache_key) is not None:
+                continue
             try:
-                # Use context manager to ensure image is properly closed
-                with Image.open(image_path) as img:
-                    width, height = img.size
-                    format_name = img.format or "unknown"
-                    
-                    # If image is too large, resize it to reduce API payload and memory usage
-                    if width * height > 4000000:  # 4 million pixels
-                        factor = (width * height / 4000000) ** 0.5
-                        new_width = int(width / factor)
-                        new_height = int(height / factor)
-                        
-                        # Create a new image inside this context - will be auto-closed
-                        resized_img = img.resize((new_width, new_height))
-                        
-                        # Save to a temporary file
-                        temp_path = f"{os.path.splitext(image_path)[0]}_resized.jpg"
-                        resized_img.save(temp_path, format="JPEG", quality=80)
-                        
-                        # Update path to use resized image
-                        image_path_to_use = temp_path
-                        format_name = "jpeg"
-            except Exception as img_error:
-                logging.error(f"Error processing image {image_path}: {str(img_error)}")
-                raise ValueError(f"Image processing error: {str(img_error)}")
+                payload = build_description_payload(image_path, image_data, subject, audience)
+            except DescriptionError:
+                continue  # The real-time pass reports the error for this image
             
-            # Encode the image to base64 with memory-efficient approach
-            base64_image = None
-            try:
-                with open(image_path_to_use, "rb") as image_file:
-                    image_data = image_file.read()
-                    base64_image = base64.b64encode(image_data).decode('utf-8')
-                    # Explicitly delete large variables to free memory
-                    del image_data
-            except Exception as encode_error:
-                logging.error(f"Error encoding image {image_path_to_use}: {str(encode_error)}")
-                raise ValueError(f"Image encoding error: {str(encode_error)}")
+            custom_id = str(len(cache_keys))
+            cache_keys[custom_id] = cache_key
+            queued_keys.add(cache_key)
+            line = orjson.dumps({
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": payload
+            }) + b"\n"
             
-            # Get API key from environment
-            api_key = os.getenv("OPENAI_API_KEY")
-            if not api_key:
-                raise ValueError("OpenAI API key not found in environment variables")
-                
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {api_key}"
-            }
+            if input_file is not None and (
+                request_count >= BATCH_INPUT_MAX_REQUESTS
+                or input_file.tell() + len(line) > BATCH_INPUT_MAX_BYTES
+            ):
+                batch_ids.append(submit_batch(input_file, client))
+                input_file.close()
+                input_file = None
+            if input_file is None:
+                input_file = tempfile.TemporaryFile()
+                request_count = 0
+            input_file.write(line)
+            request_count += 1
+        
+        if input_file is not None:
+            batch_ids.append(submit_batch(input_file, client))
+            input_file.close()
+            input_file = None
+        
+        logging.info(f"Submitted {len(cache_keys)} images to the Batch API in {len(batch_ids)} batches")
+        
+        described = 0
+        while batch_ids:
+            for custom_id, description in wait_for_batch(batch_ids[0], client):
+                cache.set(cache_keys[custom_id], description)
+                described += 1
+            batch_ids.pop(0)
+        return described
+    except BaseException:
+        # Includes the worker shutting down mid-wait
+        for batch_id in batch_ids:
+            cancel_batch(batch_id, client)
+        raise
+    finally:
+        if input_file is not None:
+            input_file.close()
+        close_zip_handles()
+
+def read_image_files(image_paths):
+    """
+    Read several image files, asking the kernel to fetch them all up front.
+    
+    Where posix_fadvise is available, every file is marked WILLNEED before any
+    is read, so readahead for the whole batch is queued together instead of
+    each read waiting on the disk in turn. On tmpfs this is a harmless no-op.
+    """
+    files = []
+    try:
+        for image_path in image_paths:
+            files.append(open_image(image_path))
+            if hasattr(os, "posix_fadvise") and not isinstance(image_path, ZipMember):
+                os.posix_fadvise(files[-1].fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+        return [image_file.read() for image_file in files]
+    finally:
+        for image_file in files:
+            image_file.close()
+
+def parse_batch_reply(reply, image_count):
+    """
+    Match the descriptions in a batched structured reply to their images.
+    
+    Args:
+        reply: JSON reply text following BATCH_RESPONSE_FORMAT
+        image_count: Number of images sent, numbered from 1
+        
+    Returns:
+        List of descriptions in image order, or None unless every image is
+        described exactly once with a non-empty description
+    """
+    try:
+        items = orjson.loads(reply)["descriptions"]
+        descriptions = {}
+        for item in items:
+            number = item["image"]
+            description = item["description"].strip()
+            if number in descriptions or not 1 <= number <= image_count or not description:
+                return None
+            descriptions[number] = description
+    except (orjson.JSONDecodeError, KeyError, TypeError, AttributeError):
+        return None
+    if len(descriptions) != image_count:
+        return None
+    return [descriptions[number] for number in range(1, image_count + 1)]
+
+def generate_batch_descriptions(image_paths, subject, audience, metas=None, max_retries=3, client=None):
+    """
+    Generate descriptions for several images with a single API call.
+    
+    The images are sent in one user message, each labelled with its number, and
+    the model replies with JSON that pairs every description with that number.
+    This shares the prompt and the round-trip between the images. Unless the
+    reply describes every image exactly once, nothing from it is used or cached
+    and each image is described on its own.
+    
+    Args:
+        image_paths: Paths to the image files, or ZipMembers
+        subject: The subject area (e.g., Mathematics, Biology)
+        audience: The target audience (e.g., Elementary school students)
+        metas: Optional list of ImageMeta matching image_paths
+        max_retries: Maximum number of retries on API failure
+        client: Optional httpx client to send the API call on
+        
+    Returns:
+        List of descriptions in the same order as image_paths
+    """
+    client = client or _client
+    metas = metas or [None] * len(image_paths)
+    
+    def describe_one(image_path, meta):
+        # A failure is kept to its own row instead of failing the whole chunk
+        try:
+            return generate_image_description(image_path, subject, audience, max_retries, client, meta)
+        except Exception as e:
+            logging.error(f"Error describing {image_name(image_path)}: {str(e)}")
+            return f"Error generating description: {str(e)}"
+    
+    def describe_individually():
+        return [describe_one(image_path, meta) for image_path, meta in zip(image_paths, metas)]
+    
+    if len(image_paths) == 1:
+        return [describe_one(image_paths[0], metas[0])]
+    
+    # Serve cached images directly and batch the rest. Images identical to one
+    # already being described, here or by another request, wait for its result.
+    cache = get_description_cache()
+    descriptions = [None] * len(image_paths)
+    uncached = []
+    duplicates = []
+    claimed = set()
+    fall_back = False
+    try:
+        for i, image_data in enumerate(read_image_files(image_paths)):
+            cache_key = cache.make_key(image_data, subject, audience)
+            descriptions[i] = cache.get(cache_key)
+            if descriptions[i] is not None:
+                continue
+            if cache_key in claimed or not cache.claim(cache_key):
+                duplicates.append((i, cache_key))
+            else:
+                claimed.add(cache_key)
+                uncached.append((i, image_data, cache_key))
+        
+        if uncached:
+            content = [{
+                "type": "text",
+                "text": f"Please describe each of the following {len(uncached)} images for {audience} (blind students) "
+                        f"studying {subject}. Give one description per image, each with the number of the image it describes."
+            }]
+            for number, (i, image_data, _) in enumerate(uncached, 1):
+                content.append({"type": "text", "text": f"Image {number}:"})
+                content.append(build_image_content(image_paths[i], image_data, metas[i]))
             
-            # Prepare payload for GPT-4 Vision API
             payload = {
-                "model": "gpt-4o",
-                "messages": [
-                    {
-                        "role": "system", 
-                        # "content": f"You are a VI educator, expert at describing images for {audience} (blind students) studying {subject}. "
-                        #           f"Provide clear, detailed, and educational descriptions that focus on aspects "
-                        #           f"relevant to {subject}. Avoid adding irrelevant information like colours, "
-                        #           f"Be factual, educational, and appropriate for the audience level."
-                        "content": f"Generate image description for a blind person, keep it contextual, considering the age and grade of the book."
-                        f"Go from general to specific, be concise and objective and keep tone and language of the description relevant to the grade of the book."
-                        f"Don't include colours and irrelevant information and make it straightforward."
-                    },
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": f"Please describe this image for {audience} (blind students) studying {subject}."},
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/{format_name.lower()};base64,{base64_image}"
-                                }
-                            }
-                        ]
-                    }
-                ],
-                "max_tokens": 300
+                "model": OPENAI_MODEL,
+                "messages": [SYSTEM_MESSAGE, {"role": "user", "content": content}],
+                "max_tokens": 300 * len(uncached),
+                "response_format": BATCH_RESPONSE_FORMAT
             }
+            label = f"batch of {len(uncached)} images"
+            reply = call_with_retries(lambda: request_completion(payload, client, label), max_retries, label)
             
-            # Explicit cleanup of large variables
-            del base64_image
-            gc.collect()
-            
-            # Make the API request with proper error handling and timeout
-            try:
-                response = requests.post(
-                    "https://api.openai.com/v1/chat/completions",
-                    headers=headers,
-                    json=payload,
-                    timeout=90  # 90 second timeout - increased for safety
-                )
-                
-                # Check if the response status code indicates success
-                response.raise_for_status()
-                
-                # Parse the response JSON
-                response_data = response.json()
-                
-                if 'error' in response_data:
-                    raise ValueError(f"API Error: {response_data['error']['message']}")
-                    
-                # Extract the description
-                description = response_data['choices'][0]['message']['content']
-                logging.info(f"Generated description for {os.path.basename(image_path)}")
-                
-                # Clean up temporary file if we created one
-                if temp_path and os.path.exists(temp_path):
-                    try:
-                        os.remove(temp_path)
-                    except Exception as rm_error:
-                        logging.warning(f"Failed to remove temp file {temp_path}: {str(rm_error)}")
-                
-                # Clean up response data
-                del response_data
-                del response
-                gc.collect()
-                    
-                return description
-                
-            except requests.exceptions.HTTPError as http_err:
-                raise ValueError(f"HTTP Error: {http_err}")
-            except requests.exceptions.ConnectionError:
-                raise ValueError("Connection Error: Could not connect to OpenAI API")
-            except requests.exceptions.Timeout:
-                logging.error(f"API request timed out for {os.path.basename(image_path)}")
-                raise ValueError("Timeout Error: The request to OpenAI API timed out")
-            except requests.exceptions.RequestException as req_err:
-                raise ValueError(f"Request Error: {req_err}")
-            
-        except Exception as e:
-            retry_count += 1
-            logging.warning(f"Attempt {retry_count}/{max_retries} failed for {image_path}: {str(e)}")
-            
-            if retry_count < max_retries:
-                logging.info(f"Retrying in {backoff_time} seconds...")
-                time.sleep(backoff_time)
-                backoff_time *= 2  # Exponential backoff
+            parts = parse_batch_reply(reply, len(uncached))
+            if parts is not None:
+                for (i, _, cache_key), description in zip(uncached, parts):
+                    descriptions[i] = description
+                    cache.set(cache_key, description)
+                    logging.info(f"Generated description for {image_name(image_paths[i])}")
             else:
-                logging.error(f"Failed to generate description after {max_retries} attempts: {str(e)}")
-                
-                # Clean up temporary file if we created one
-                if temp_path and os.path.exists(temp_path):
-                    try:
-                        os.remove(temp_path)
-                    except Exception:
-                        pass
-                    
-                return f"Error generating description after {max_retries} attempts: {str(e)}"
-        
-        finally:
-            # Force garbage collection
-            gc.collect()
+                logging.warning(f"Batched reply did not describe each of the {len(uncached)} images exactly once; "
+                                f"describing images individually")
+                fall_back = True
+    except Exception as e:
+        logging.warning(f"Batched description request failed, describing images individually: {str(e)}")
+        fall_back = True
+    finally:
+        # Claims must be released before waiting on or describing any image
+        for cache_key in claimed:
+            cache.release(cache_key)
+    
+    if fall_back:
+        return describe_individually()
+    
+    for i, cache_key in duplicates:
+        descriptions[i] = cache.wait(cache_key)
+        if descriptions[i] is None:
+            descriptions[i] = describe_one(image_paths[i], metas[i])
+    return descriptions
 
-def process_individual_images(image_paths, output_dir, subject, audience, batch_size=1):
+def process_individual_images(image_paths, output_dir, subject, audience, batch_size=16):
     """
     Process a list of individual image files with improved memory management.
     
     Args:
-        image_paths: List of paths to image files
+        image_paths: Iterable of paths to image files or ZipMembers; it is consumed
+            as it is produced, so a generator overlaps with the work
         output_dir: Directory to save results
         subject: Subject area for context
         audience: Target audience for descriptions
-        batch_size: Number of images to process in a batch before saving progress
+        batch_size: Number of result rows buffered before the progress log is flushed;
+            rows lost in a crash are served from the description cache on resume
         
     Returns:
         Dictionary with processing results
     """
     results = []
+    from_progress_log = False
     already_processed = set()
     total_images = 0
     
-    logging.info(f"Processing {len(image_paths)} individual images")
-    
     # Save progress periodically to avoid losing work on timeout
     excel_file = os.path.join(output_dir, "descriptions.xlsx")
+    progress_file = progress_file_for(excel_file)
     
-    # Check if progress file exists and load it
-    if os.path.exists(excel_file):
-        try:
-            existing_df = pd.read_excel(excel_file)
-            results = existing_df.to_dict('records')
-            
-            # Track already processed files
-            for row in results:
-                already_processed.add(row.get("Filename", ""))
-                
+    # Check if an interrupted run's progress log or a finished spreadsheet exists and load it
+    try:
+        if os.path.exists(progress_file):
+            results = load_progress_log(progress_file)
+            from_progress_log = True
+            logging.info(f"Loaded {len(results)} existing results from {progress_file}")
+        elif os.path.exists(excel_file):
+            results = load_results_from_excel(excel_file)
             logging.info(f"Loaded {len(results)} existing results from {excel_file}")
-        except Exception as e:
-            logging.error(f"Error loading existing progress file: {str(e)}")
+    except Exception as e:
+        logging.error(f"Error loading existing progress file: {str(e)}")
     
-    for i, image_path in enumerate(image_paths):
-        # Handle potential encoding issues with filenames
-        try:
-            filename = os.path.basename(image_path)
+    # Rows are streamed to disk as they are produced instead of kept in memory
+    writer = ResultsWriter(excel_file, flush_every=batch_size)
+    for row in results:
+        # Track already processed files
+        already_processed.add(row.get("Filename", ""))
+        if from_progress_log:
+            writer.add_row(row)  # Already recorded in the log
+        else:
+            writer.write(row)
+    results = None
+    
+    def new_images():
+        # Skip images that are already done, or named like an earlier image, as paths arrive
+        for i, image_path in enumerate(image_paths):
+            # Handle potential encoding issues with filenames
+            try:
+                filename = image_name(image_path)
+            except Exception:
+                filename = f"unknown_file_{i}"
             
             # Skip already processed images
             if filename in already_processed:
                 logging.info(f"Skipping already processed image: {filename}")
                 continue
-                
-            # Get image dimensions with proper cleanup
-            width, height, format_name = 0, 0, "Unknown"
-            
-            try:
-                # Use context manager for auto-closing
-                with Image.open(image_path) as img:
-                    width, height = img.size
-                    format_name = img.format or "Unknown"
-            except Exception as img_error:
-                logging.error(f"Error reading image {image_path}: {str(img_error)}")
-                # Continue processing with default values
-                
+            already_processed.add(filename)
+            yield image_path, filename
+    
+    images = new_images()
+    
+    # Large jobs are described through the Batch API first; its results land in
+    # the description cache, so the pass below mostly serves cache hits and only
+    # sends the images the batch failed on to the real-time endpoint. It gets
+    # exactly the images that pass will describe, so skipped ones are never billed.
+    if OAI_BATCH_API_THRESHOLD > 0:
+        images = list(images)
+        if len(images) >= OAI_BATCH_API_THRESHOLD:
             try:
-                # Generate the description
-                description = generate_image_description(image_path, subject, audience)
-                
-                # Add to results
-                results.append({
-                    "Filename": filename,
-                    "Format": format_name,
-                    "Width": width,
-                    "Height": height,
-                    "Subject": subject,
-                    "Audience": audience,
-                    "Description": description,
-                    "Generated At": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                })
-                
-                total_images += 1
-                already_processed.add(filename)
-                
-            except Exception as desc_error:
-                logging.error(f"Error generating description for {filename}: {str(desc_error)}")
-                
-                # Add error entry to results
-                results.append({
-                    "Filename": filename,
-                    "Format": format_name,
-                    "Width": width, 
-                    "Height": height,
-                    "Subject": subject,
-                    "Audience": audience,
-                    "Description": f"Error generating description: {str(desc_error)}",
-                    "Generated At": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                })
-                already_processed.add(filename)
-                
-            # Save progress after each batch or after processing an image that had errors
-            if (i + 1) % batch_size == 0 or i == len(image_paths) - 1:
-                save_progress_to_excel(results, excel_file)
-                logging.info(f"Progress saved: {len(already_processed)}/{len(image_paths)} images processed")
+                prefill_cache_with_batch_api([image_path for image_path, _ in images], subject, audience)
+            except Exception as e:
+                logging.error(f"Batch API job failed, describing images in real time: {str(e)}")
+    
+    # Describe images concurrently; the shared HTTP/2 client multiplexes the
+    # worker threads' calls so none of them pays for a new TLS handshake. The
+    # prefetch threads keep encoded payloads ready behind the in-flight requests.
+    chunks = []
+    chunk_indexes = {}
+    processed_count = 0
+    try:
+        with ThreadPoolExecutor(max_workers=OAI_CONCURRENCY + OAI_PREFETCH) as executor:
+            def describe_chunk(chunk, metas):
+                # Headers are read on the pool too, so probing runs in parallel and
+                # never delays handing the next chunk to a free thread
+                image_paths = [image_path for image_path, _ in chunk]
+                for index, image_path in enumerate(image_paths):
+                    metas[index] = read_image_meta(image_path)
+                return generate_batch_descriptions(image_paths, subject, audience, metas=metas)
             
-            # Force garbage collection after each image
-            gc.collect()
+            def submit(chunk):
+                metas = [UNKNOWN_IMAGE_META] * len(chunk)
+                chunks.append((chunk, metas))
+                chunk_indexes[executor.submit(describe_chunk, chunk, metas)] = len(chunks) - 1
             
-        except Exception as e:
-            logging.error(f"Critical error processing image path {i}: {str(e)}")
-            logging.error(traceback.format_exc())
+            # Images are grouped so several share one API request, and each group
+            # is submitted once full, so requests start while paths are still arriving.
+            chunk = []
+            for image_path, filename in images:
+                chunk.append((image_path, filename))
+                if len(chunk) == OAI_BATCH_SIZE:
+                    submit(chunk)
+                    chunk = []
+            if chunk:
+                submit(chunk)
             
-            # Try to get filename even in error cases
-            try:
-                filename = os.path.basename(image_path)
-            except:
-                filename = f"unknown_file_{i}"
-                
-            # Add error to results
-            results.append({
-                "Filename": filename,
-                "Format": "Error",
-                "Width": 0,
-                "Height": 0,
-                "Subject": subject,
-                "Audience": audience,
-                "Description": f"Critical error: {str(e)}",
-                "Generated At": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            })
+            pending_count = sum(len(chunk) for chunk, _ in chunks)
+            logging.info(f"Processing {pending_count} individual images")
             
-            # Save progress after critical error
-            save_progress_to_excel(results, excel_file)
-            
-            # Force garbage collection after error
-            gc.collect()
+            # Record each chunk in the progress log as soon as it finishes, so a slow
+            # request never holds back checkpointing of later ones; rows are added to
+            # the workbook in input order so the spreadsheet follows the upload order.
+            # A chunk's future and metadata are dropped once handled, so memory only
+            # holds chunks still in flight or waiting on an earlier one.
+            finished_rows = {}
+            next_chunk_index = 0
+            for future in as_completed(chunk_indexes):
+                chunk_index = chunk_indexes.pop(future)
+                chunk, metas = chunks[chunk_index]
+                chunks[chunk_index] = None
+                try:
+                    descriptions = future.result()
+                    total_images += len(chunk)
+                except Exception as desc_error:
+                    logging.error(f"Error generating descriptions for {len(chunk)} images: {str(desc_error)}")
+                    logging.error(traceback.format_exc())
+                    descriptions = [f"Error generating description: {str(desc_error)}"] * len(chunk)
+                
+                # Every image in a chunk finished at the same moment, so they share one timestamp
+                generated_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                rows = []
+                for (_, filename), meta, description in zip(chunk, metas, descriptions):
+                    row = {
+                        "Filename": filename,
+                        "Format": meta.format,
+                        "Width": meta.width,
+                        "Height": meta.height,
+                        "Subject": subject,
+                        "Audience": audience,
+                        "Description": description,
+                        "Generated At": generated_at
+                    }
+                    rows.append(row)
+                writer.record_rows(rows)
+                finished_rows[chunk_index] = rows
+                
+                while next_chunk_index in finished_rows:
+                    for row in finished_rows.pop(next_chunk_index):
+                        writer.add_row(row)
+                    next_chunk_index += 1
+                
+                processed_count += len(chunk)
+                logging.info(f"Progress saved: {processed_count}/{pending_count} images processed")
+    except BaseException:
+        # Keep the progress log so a rerun resumes where this one stopped
+        writer.abort()
+        raise
     
     # Final save
-    save_progress_to_excel(results, excel_file)
+    writer.close()
     
     return {
         "total_images": total_images,
         "excel_file": excel_file
     }
 
-def save_progress_to_excel(results, excel_file):
-    """Helper function to safely save progress to Excel file"""
-    for attempt in range(3):  # Try up to 3 times
+def load_results_from_excel(excel_file):
+    """Read previously saved result rows back from an Excel file."""
+    # Only needed when resuming, so keep openpyxl out of every process's startup
+    import openpyxl
+    
+    workbook = openpyxl.load_workbook(excel_file, read_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = next(rows, None)
+        if not header:
+            return []
+        return [dict(zip(header, row)) for row in rows]
+    finally:
+        workbook.close()
+
+def load_progress_log(progress_file):
+    """
+    Read result rows back from a JSON-lines progress log.
+    
+    A partly written last line from an interrupted run is cut off the file, so
+    rows appended on resume start on a fresh line instead of being glued to it.
+    """
+    results = []
+    complete_length = 0
+    with open(progress_file, "r+b") as log_file:
+        for line in log_file:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                results.append(orjson.loads(line))
+            except orjson.JSONDecodeError:
+                break
+            complete_length += len(line)
+        log_file.truncate(complete_length)
+    return results
+
+class ResultsWriter:
+    """
+    Streams result rows into the descriptions spreadsheet as they are produced.
+    
+    Rows go straight to an xlsxwriter workbook in constant_memory mode, so memory
+    use does not grow with the size of the job, and are appended to a JSON-lines
+    progress log so an interrupted job can resume. The workbook is built next to
+    the target and moved into place on close, so readers never see a partial file.
+    """
+    
+    def __init__(self, excel_file, flush_every=1):
+        self.excel_file = excel_file
+        self.progress_file = progress_file_for(excel_file)
+        self._temp_file = f"{excel_file}.tmp"
+        self._flush_every = flush_every
+        # Cells are written verbatim: this skips the URL regex and formula check
+        # xlsxwriter otherwise runs on every string, and keeps model output that
+        # happens to start with '=' or look like a link from changing meaning
+        self._workbook = xlsxwriter.Workbook(self._temp_file, {
+            'constant_memory': True,
+            'strings_to_urls': False,
+            'strings_to_formulas': False
+        })
+        self._worksheet = self._workbook.add_worksheet()
+        self._worksheet.write_row(0, 0, RESULT_COLUMNS)
+        self._row_idx = 1
+        self._unflushed = 0
+        self._log = open(self.progress_file, "ab")
+    
+    def add_row(self, row):
+        """Append a row to the workbook only, e.g. one restored from the progress log."""
+        self._worksheet.write_row(self._row_idx, 0, [row.get(column) for column in RESULT_COLUMNS])
+        self._row_idx += 1
+    
+    def record(self, row):
+        """Append a row to the progress log only."""
+        self.record_rows([row])
+    
+    def record_rows(self, rows):
+        """Append several rows to the progress log in a single write."""
+        self._log.write(b"".join(orjson.dumps(row) + b"\n" for row in rows))
+        self._unflushed += len(rows)
+        if self._unflushed >= self._flush_every:
+            self._log.flush()
+            self._unflushed = 0
+    
+    def write(self, row):
+        """Write a new row to the workbook and record it in the progress log."""
+        self.add_row(row)
+        self.record(row)
+    
+    def abort(self):
+        """Stop writing after a failure, keeping the progress log for a later resume."""
+        self._log.close()
         try:
-            pd.DataFrame(results).to_excel(excel_file, index=False)
-            return  # Success, exit function
-        except Exception as save_error:
-            logging.error(f"Save attempt {attempt+1} failed: {str(save_error)}")
-            time.sleep(1)  # Wait a bit before retrying
-            
-            if attempt == 1:  # On second attempt, try alternative method
-                try:
-                    with pd.ExcelWriter(excel_file, engine='openpyxl') as writer:
-                        pd.DataFrame(results).to_excel(writer, index=False)
-                    return  # Success with alternative method
-                except Exception as alt_error:
-                    logging.error(f"Alternative save method failed: {str(alt_error)}")
+            self._workbook.close()
+        finally:
+            if os.path.exists(self._temp_file):
+                os.remove(self._temp_file)
     
-    logging.error("All attempts to save progress failed")
+    def close(self):
+        """Finish the workbook, move it into place and drop the progress log."""
+        self._log.close()
+        self._workbook.close()
+        for attempt in range(3):  # Try up to 3 times
+            try:
+                os.replace(self._temp_file, self.excel_file)
+                break
+            except OSError as save_error:
+                logging.error(f"Save attempt {attempt+1} failed: {str(save_error)}")
+                if attempt == 2:
+                    raise
+                time.sleep(1)  # Wait a bit before retrying
+        os.remove(self.progress_file)
+
+def progress_file_for(excel_file):
+    """Return the path of the progress log kept alongside excel_file."""
+    return f"{os.path.splitext(excel_file)[0]}.progress.jsonl"
 
 def process_zip_file(zip_path, output_dir, subject, audience):
     """
@@ -379,16 +1523,10 @@ def process_zip_file(zip_path, output_dir, subject, audience):
     Returns:
         Dictionary with processing results
     """
-    # Create a directory for extracted files
-    extract_dir = os.path.join(os.path.dirname(zip_path), "extracted")
-    os.makedirs(extract_dir, exist_ok=True)
-    
-    # Extract the zip file
-    logging.info(f"Extracting zip file: {zip_path}")
-    image_paths = extract_zip(zip_path, extract_dir)
-    
-    # Process the extracted images with smaller batch size for memory efficiency
+    # Images are read straight out of the archive by the worker threads, so
+    # nothing is extracted to disk and tmpfs holds only the uploaded ZIP
+    logging.info(f"Reading zip file: {zip_path}")
+    image_paths = list_zip_images(zip_path)
     logging.info(f"Found {len(image_paths)} images in zip file")
     
-    # Use a smaller batch size (1) to avoid memory issues
-    return process_individual_images(image_paths, output_dir, subject, audience, batch_size=1)
\ No newline at end of file
+    return process_individual_images(image_paths, output_dir, subject, audience)
\ No newline at end of file
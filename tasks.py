@@ -0,0 +1,83 @@
+import os
+import logging
+import shutil
+import threading
+from celery import Celery
+from celery.result import AsyncResult
+# Import our image processing module
+from image_processor import process_zip_file, process_individual_images
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+REDIS_URL = os.getenv('REDIS_URL')
+
+# Redis is used both as the broker and to store job state for /jobs/<job_id>
+celery_app = Celery('img', broker=REDIS_URL, backend=REDIS_URL)
+celery_app.conf.update(
+    task_routes={'tasks.process_job': {'queue': 'descriptions'}},
+    task_track_started=True,
+)
+
+# Written to a job's output directory when it fails on a background thread,
+# where there is no result backend to record the failure
+JOB_FAILED_MARKER = '.failed'
+
+@celery_app.task(name='tasks.process_job')
+def process_job(file_paths, output_dir, subject, audience, is_zip):
+    """
+    Generate descriptions for an uploaded job in a Celery worker.
+
+    Args:
+        file_paths: Paths of the saved uploads (a single ZIP file or image files)
+        output_dir: Directory to save results
+        subject: Subject area for context
+        audience: Target audience for descriptions
+        is_zip: Whether file_paths holds a single ZIP file
+
+    Returns:
+        Dictionary with processing results
+    """
+    try:
+        if is_zip:
+            return process_zip_file(file_paths[0], output_dir, subject, audience)
+        return process_individual_images(file_paths, output_dir, subject, audience)
+    finally:
+        # Uploads are not needed once the spreadsheet is written;
+        # removing them keeps tmpfs-backed storage from growing with every job
+        upload_dir = os.path.dirname(file_paths[0])
+        shutil.rmtree(upload_dir, ignore_errors=True)
+
+def submit_job(job_id, file_paths, output_dir, subject, audience, is_zip):
+    """
+    Start a job without waiting for it.
+    
+    With a broker the job goes to a Celery worker, using the job ID as the task ID.
+    Without one it runs on a background thread of this process, so the upload
+    request still returns at once; such a job is lost if the process restarts.
+    """
+    args = (file_paths, output_dir, subject, audience, is_zip)
+    if REDIS_URL:
+        process_job.apply_async(args=args, task_id=job_id)
+        return
+    
+    def run():
+        try:
+            process_job(*args)
+        except Exception as e:
+            logging.error(f"Job {job_id} failed: {str(e)}")
+            open(os.path.join(output_dir, JOB_FAILED_MARKER), 'w').close()
+    
+    threading.Thread(target=run, name=f"job-{job_id}").start()
+
+def get_job_state(job_id, output_dir):
+    """
+    Return the Celery state of a job. Without a result backend this is 'FAILURE'
+    if the job's background thread failed and None otherwise.
+    """
+    if not REDIS_URL:
+        return 'FAILURE' if os.path.exists(os.path.join(output_dir, JOB_FAILED_MARKER)) else None
+    return AsyncResult(job_id, app=celery_app).state